@@ -315,7 +315,7 @@ class BinariesCheck(AbstractCheck):
             stack_headers = [h for h in self.readelf_parser.program_header_info.headers if h.name == 'GNU_STACK']
             if not stack_headers:
                 self.output.add_info('E', pkg, 'missing-PT_GNU_STACK-section', pkgfile.name)
-            elif 'E' in stack_headers[0].flags:
+            elif stack_headers[0].has_exec:
                 self.output.add_info('E', pkg, 'executable-stack', pkgfile.name)
 
     def _check_soname_symlink(self, pkg, shlib, soname):
@@ -630,6 +630,13 @@ class BinariesCheck(AbstractCheck):
         pkg_has_usrlib_file = False
         pkg_has_file_in_lib64 = False
 
+        # parse the ELF files checked below with as few readelf runs as possible
+        if pkg.arch != 'noarch':
+            ReadelfParser.bulk_parse([pkgfile.path for fname, pkgfile in pkg.files.items()
+                                      if self.elf_regex.match(pkgfile.magic) and
+                                      'eBPF' not in pkgfile.magic and
+                                      not fname.endswith(('.o', '.static', '.gox', '.go'))])
+
         #  go through the all files, run files checks and collect data that are
         #  needed later
         for fname, pkgfile in pkg.files.items():
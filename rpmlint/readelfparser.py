@@ -1,16 +1,42 @@
-from itertools import dropwhile, takewhile
+from collections import namedtuple
+import concurrent.futures
+from functools import lru_cache
+import os
 import re
+import shutil
 import subprocess
+import sys
+import tempfile
 
 from rpmlint.helpers import ENGLISH_ENVIRONMENT
 
 
+ElfInfo = namedtuple('ElfInfo', ('readelf_failed_reason', 'section_info', 'program_header_info',
+                                 'dynamic_section_info', 'symbol_table_info', 'comment_section_info'))
+
+
+@lru_cache(maxsize=None)
+def readelf_path():
+    """
+    Return the absolute path of readelf, resolved once.
+
+    CPython spawns the child with posix_spawn() (vfork-like, no page table
+    copy of a large rpmlint process) only when the executable is given
+    with a directory and close_fds is False; all our descriptors are
+    non-inheritable anyway (PEP 446).
+    """
+    return shutil.which('readelf') or 'readelf'
+
+
 class ElfSection:
     """
     A simple wrapper representing one ELF section.
     """
+    __slots__ = ('name', 'size')
+
     def __init__(self, name, size):
-        self.name = name
+        # the same names repeat in every member of an archive
+        self.name = sys.intern(name)
         self.size = int(size, 16)
 
 
@@ -18,24 +44,30 @@ class ElfProgramHeader:
     """
     A simple wrapper representing one ELF program header.
     """
+    __slots__ = ('name', 'flags', 'has_exec')
+
     def __init__(self, name, flags):
-        self.name = name
-        self.flags = flags.replace(' ', '')
+        # types and flags come from small fixed sets
+        self.name = sys.intern(name)
+        self.flags = sys.intern(''.join(flags.split()))
+        self.has_exec = 'E' in self.flags
 
 
 class ElfDynamicSection:
     """
     A simple wrapper representing one ELF dynamic section entry.
     """
+    __slots__ = ('key', 'value')
+
     def __init__(self, key, value):
-        self.key = key
+        self.key = sys.intern(key)
         self.value = value
 
 
 class ElfSectionInfo:
     """
     Class contains information about ELF sections of an ELF file. The information
-    is get with the following command line: readelf -WS.
+    is get from the 'Section Headers:' part of readelf -WS output.
 
     Output example:
 
@@ -62,33 +94,24 @@ class ElfSectionInfo:
       l (large), p (processor specific)
     """
 
-    section_regex = re.compile(r'.*\] (?P<section>\S*)\s*\S+\s*\S*\s*\S*\s*(?P<size>\w*)')
-    pic_regex = re.compile(r'\.rela?\.(data|text)')
+    section_regex = re.compile(r'\s*\[\s*\d+\] (?P<section>\S*)\s+\S+\s+\S+\s+\S+\s+(?P<size>\w+)', re.ASCII)
+    pic_prefixes = ('.rel.text', '.rela.text', '.rel.data', '.rela.data')
+    heading = 'Section Headers:'
 
-    def __init__(self, path, extra_flags):
-        self.path = path
+    def __init__(self, lines):
         self.elf_files = []
-        self.parsing_failed_reason = None
         self.pic = False
-        self.extra_flags = extra_flags
-        self.parse()
+        self.parse(lines)
 
-    def parse(self):
-        r = subprocess.run(['readelf', '-W', '-S', self.path] + self.extra_flags, encoding='utf8',
-                           errors='replace', capture_output=True, env=ENGLISH_ENVIRONMENT)
-        if r.returncode != 0:
-            self.parsing_failed_reason = r.stderr
-            return
-
-        lines = r.stdout.splitlines()
-        needle = 'Section Headers:'
+    def parse(self, lines):
+        needle = self.heading
+        match = self.section_regex.match
 
         # archive files can contain multiple files
         i = 0
         length = len(lines)
 
         while i < length:
-            parsed_sections = []
             while needle not in lines[i]:
                 i += 1
                 if i == length:
@@ -97,21 +120,19 @@ class ElfSectionInfo:
             # skip header and empty section
             i += 3
 
-            sections = []
-            while 'Key to Flags:' not in lines[i]:
-                sections.append(lines[i])
+            parsed_sections = []
+            add_section = parsed_sections.append
+            while i < length and 'Key to Flags:' not in lines[i]:
+                r = match(lines[i])
                 i += 1
-
-            for s in sections:
-                r = self.section_regex.search(s)
-                section = ElfSection(r.group('section'), r.group('size'))
-                parsed_sections.append(section)
+                section = ElfSection(*r.group('section', 'size'))
+                add_section(section)
 
                 # detect a PIC section
-                if self.pic_regex.search(section.name) is not None:
+                if not self.pic and section.name.startswith(self.pic_prefixes):
                     self.pic = True
 
-            if len(parsed_sections) > 0:
+            if parsed_sections:
                 self.elf_files.append(parsed_sections)
 
 
@@ -133,38 +154,40 @@ class ElfProgramHeaderInfo:
       GNU_RELRO      0x002e00 0x0000000000403e00 0x0000000000403e00 0x000200 0x000200 R   0x1
     """
 
-    header_regex = re.compile('\\s+(?P<header>\\w+)(\\s+\\w+){5}\\s+(?P<flags>[RWE ]{3}).*')
+    heading = 'Program Headers:'
 
-    def __init__(self, path, extra_flags):
-        self.path = path
+    def __init__(self, lines):
         self.headers = []
-        self.parsing_failed_reason = None
-        self.extra_flags = extra_flags
-        self.parse()
+        self.parse(lines)
 
-    def parse(self):
-        r = subprocess.run(['readelf', '-W', '-l', self.path] + self.extra_flags, encoding='utf8',
-                           errors='replace', capture_output=True, env=ENGLISH_ENVIRONMENT)
-        if r.returncode != 0:
-            self.parsing_failed_reason = r.stderr
-            return
+    def parse(self, lines):
+        needle = self.heading
 
-        lines = r.stdout.splitlines()
-        needle = 'Program Headers:'
+        # archive files can contain multiple files
+        i = 0
+        length = len(lines)
 
-        while len(lines) > 0:
-            lines = list(dropwhile(lambda x: needle not in x, lines))
+        while i < length:
+            while needle not in lines[i]:
+                i += 1
+                if i == length:
+                    return
 
             # skip header
-            lines = lines[2:]
+            i += 2
 
-            sections = list(takewhile(lambda x: x.strip() != '', lines))
-            for s in sections:
-                r = self.header_regex.search(s)
-                if r is not None:
-                    self.headers.append(ElfProgramHeader(r.group('header'), r.group('flags')))
-
-            lines = lines[len(sections):]
+            while i < length and lines[i].strip():
+                line = lines[i]
+                i += 1
+                # skip e.g. the program interpreter line
+                if not line.startswith('  ') or not line[2:3].isupper():
+                    continue
+                # Type Offset VirtAddr PhysAddr FileSiz MemSiz Flg Align, where
+                # Flg is 'R E'-like and may be split to several fields or be empty
+                parts = line.split()
+                if len(parts) < 7:
+                    continue
+                self.headers.append(ElfProgramHeader(parts[0], ''.join(parts[6:-1])))
 
 
 class ElfDynamicSectionInfo:
@@ -203,36 +226,39 @@ class ElfDynamicSectionInfo:
     0x60009991 (Operating System specific: 60009991)        0x8
     """
 
-    section_regex = re.compile('\\s+\\w*\\s+\\((?P<key>[^\\)]+)\\)\\s+(?P<value>.*)')
+    section_regex = re.compile(r'\s*0x\w+\s+\((?P<key>[^)]+)\)\s+(?P<value>.*)', re.ASCII)
     soname_regex = re.compile('Library soname: \\[(?P<soname>[^\\]]+)\\]')
     needed_regex = re.compile('Shared library: \\[(?P<library>[^\\]]+)\\]')
     runpath_regex = re.compile('Library runpath: \\[(?P<path>[^\\]]+)\\]')
     rpath_regex = re.compile('Library rpath: \\[(?P<path>[^\\]]+)\\]')
+    heading = 'Dynamic section at offset'
 
-    def __init__(self, path, extra_flags):
-        self.path = path
+    def __init__(self, lines):
         self.sections = []
-        self.parsing_failed_reason = None
-        self.extra_flags = extra_flags
-        self.parse()
+        # values of the entries indexed by key, for __getitem__
+        self._by_key = {}
+        self.parse(lines)
         self.parse_meta()
 
-    def parse(self):
-        r = subprocess.run(['readelf', '-W', '-d', self.path] + self.extra_flags, encoding='utf8',
-                           errors='replace', capture_output=True, env=ENGLISH_ENVIRONMENT)
-        if r.returncode != 0:
-            self.parsing_failed_reason = r.stderr
-            return
+    def parse(self, lines):
+        needle = self.heading
 
-        lines = r.stdout.splitlines()
-        needle = 'Dynamic section at offset'
+        lines = iter(lines)
+        for line in lines:
+            if needle in line:
+                break
 
-        lines = list(dropwhile(lambda x: needle not in x, lines))
         # skip header
-        lines = lines[2:]
+        next(lines, None)
         for line in lines:
-            r = self.section_regex.search(line)
-            self.sections.append(ElfDynamicSection(r.group('key'), r.group('value')))
+            if not line.strip():
+                break
+            if '(' not in line:
+                continue
+            r = self.section_regex.match(line)
+            key, value = r.group('key', 'value')
+            self.sections.append(ElfDynamicSection(key, value))
+            self._by_key.setdefault(key, []).append(value)
 
     def parse_meta(self):
         self.soname = None
@@ -261,7 +287,7 @@ class ElfDynamicSectionInfo:
                 self.runpaths.append(r.group('path'))
 
     def __getitem__(self, key):
-        return [x.value for x in self.sections if x.key == key]
+        return list(self._by_key.get(key, ()))
 
 
 class ElfSymbolTableInfo:
@@ -276,32 +302,34 @@ class ElfSymbolTableInfo:
      8: 0000000000000000    21 FUNC    GLOBAL DEFAULT    1 main
     """
 
-    def __init__(self, path, extra_flags):
-        self.path = path
+    heading = "Symbol table '"
+
+    def __init__(self, lines):
         self.functions = set()
-        self.parsing_failed_reason = None
-        self.extra_flags = extra_flags
-        self.parse()
+        self.parse(lines)
 
-    def parse(self):
-        try:
-            r = subprocess.run(['readelf', '-Ui', '-W', '-s', self.path] + self.extra_flags, encoding='utf8',
-                               errors='replace', capture_output=True, env=ENGLISH_ENVIRONMENT)
-            if r.returncode != 0:
-                self.parsing_failed_reason = r.stderr
-                return
-
-            lines = r.stdout.splitlines()
-            for line in lines:
-                parts = line.split()
-                if len(parts) >= 8 and parts[3] == 'FUNC':
-                    self.functions.add(parts[7])
-        except UnicodeDecodeError as e:
-            self.parsing_failed_reason = str(e)
+    def parse(self, lines):
+        # local names avoid attribute lookups in this hot loop
+        add_function = self.functions.add
+        for line in lines:
+            # a substring test is much cheaper than splitting every symbol line
+            if ' FUNC ' not in line:
+                continue
+            # num: value size type bind vis ndx name [(version)]
+            parts = line.split(None, 8)
+            if len(parts) >= 8 and parts[3] == 'FUNC' and parts[0].endswith(':'):
+                add_function(parts[7])
 
     def get_functions_for_regex(self, regex):
+        """
+        Yield names of functions matching regex, either a compiled
+        pattern or a string that is compiled once for all the symbols.
+        """
+        if isinstance(regex, str):
+            regex = re.compile(regex)
+        search = regex.search
         for sym in self.functions:
-            if regex.search(sym):
+            if search(sym):
                 yield sym
 
 
@@ -321,8 +349,8 @@ class ElfCommentInfo:
         self.parse()
 
     def parse(self):
-        r = subprocess.run(['readelf', '-p', '.comment', self.path] + self.extra_flags, encoding='utf8',
-                           errors='replace', capture_output=True, env=ENGLISH_ENVIRONMENT)
+        r = subprocess.run([readelf_path(), '-p', '.comment', self.path] + self.extra_flags, encoding='utf8',
+                           errors='replace', capture_output=True, env=ENGLISH_ENVIRONMENT, close_fds=False)
         if r.returncode != 0:
             self.parsing_failed_reason = r.stderr
             return
@@ -342,28 +370,183 @@ class ReadelfParser:
 
     NOT_ELF_ERROR = 'Error: Not an ELF file - it has the wrong magic bytes at the start'
     so_regex = re.compile(r'/lib(64)?/[^/]+\.so(\.[0-9]+)*$')
+    # number of files passed to a single readelf run by bulk_parse
+    BULK_SIZE = 64
+    # parsed results of bulk_parse waiting to be picked up by _parse_elf
+    _prefetched = {}
 
     def __init__(self, pkgfile_path, path):
         self.is_archive = path.endswith('.a')
         self.is_shlib = self.so_regex.search(path)
         self.is_debug = path.endswith('.debug')
 
+        (self.readelf_failed_reason,
+         self.section_info,
+         self.program_header_info,
+         self.dynamic_section_info,
+         self.symbol_table_info,
+         self.comment_section_info) = self._parse_elf(*self._cache_key(pkgfile_path))
+
+    @classmethod
+    def bulk_parse(cls, pkgfile_paths):
+        """
+        Parse the given ELF files with one readelf run per BULK_SIZE files
+        instead of one run per file. The results are picked up by later
+        ReadelfParser instances for the same files.
+
+        Nothing is stored for a batch in which readelf fails; its files are
+        then parsed (and the errors reported) one by one as usual.
+        """
+        extra_flags = cls.readelf_extra_flags()
+        keys = [cls._cache_key(path) for path in dict.fromkeys(pkgfile_paths)]
+        # only the files we can stat can be looked up later
+        keys = [key for key in keys if key[1] is not None]
+
+        prefetched = {}
+        for i in range(0, len(keys), cls.BULK_SIZE):
+            batch = keys[i:i + cls.BULK_SIZE]
+            readelf_failed_reason, regions = cls._run_readelf([key[0] for key in batch], extra_flags)
+            if readelf_failed_reason:
+                continue
+            for key, file_regions in zip(batch, regions):
+                prefetched[key] = cls._parse_regions(file_regions)
+        cls._prefetched = prefetched
+
+    @staticmethod
+    def _cache_key(pkgfile_path):
+        """
+        The same file is inspected by several checks, key the parsed
+        result by modification time and size to catch stale entries.
+        """
+        try:
+            st = os.stat(pkgfile_path)
+            return pkgfile_path, st.st_mtime_ns, st.st_size
+        except OSError:
+            # let readelf report the problem
+            return pkgfile_path, None, None
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _parse_elf(cls, pkgfile_path, mtime, size):
+        """
+        Parse the ELF file and return an ElfInfo. The result is cached
+        by (pkgfile_path, mtime, size), mtime and size are only part of
+        the cache key.
+        """
+        extra_flags = cls.readelf_extra_flags()
+
+        # The .comment dump is a separate readelf run, let it run while
+        # the main output is read and parsed. The thread mostly waits for
+        # the subprocess, so the GIL is not a concern here.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            comment_future = executor.submit(ElfCommentInfo, pkgfile_path, extra_flags)
+            parsed = cls._prefetched.pop((pkgfile_path, mtime, size), None)
+            if parsed is None:
+                # Archives contain relocatable objects only, these have
+                # neither program headers nor a dynamic section
+                archive = cls._is_ar_archive(pkgfile_path)
+                readelf_failed_reason, (regions,) = cls._run_readelf([pkgfile_path], extra_flags,
+                                                                     headers=not archive)
+                parsed = cls._parse_regions(regions)
+            else:
+                readelf_failed_reason = None
+            return ElfInfo(readelf_failed_reason, *parsed, comment_future.result())
+
+    @staticmethod
+    def _is_ar_archive(pkgfile_path):
+        """
+        Detect an ar archive by its magic, the file name is not reliable.
+        """
+        try:
+            with open(pkgfile_path, 'rb') as f:
+                return f.read(8) in (b'!<arch>\n', b'!<thin>\n')
+        except OSError:
+            return False
+
+    @staticmethod
+    def _parse_regions(regions):
+        """
+        Return the section, program header, dynamic section and symbol
+        table information parsed from the regions of one file.
+        """
+        return (ElfSectionInfo(regions[ElfSectionInfo]),
+                ElfProgramHeaderInfo(regions[ElfProgramHeaderInfo]),
+                ElfDynamicSectionInfo(regions[ElfDynamicSectionInfo]),
+                ElfSymbolTableInfo(regions[ElfSymbolTableInfo]))
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def readelf_extra_flags():
+        """
+        Return flags supported by the installed readelf that should be
+        passed to every invocation. The readelf binary does not change
+        during a run, so it is probed only once.
+        """
         # Do not follow debug info links
-        output = subprocess.check_output('readelf --help', shell=True, encoding='utf8')
+        output = subprocess.check_output([readelf_path(), '--help'], encoding='utf8', close_fds=False)
         flag = '--debug-dump=no-follow-links'
-        extra_flags = [flag] if flag in output else []
-
-        self.section_info = ElfSectionInfo(pkgfile_path, extra_flags)
-        self.program_header_info = ElfProgramHeaderInfo(pkgfile_path, extra_flags)
-        self.dynamic_section_info = ElfDynamicSectionInfo(pkgfile_path, extra_flags)
-        self.symbol_table_info = ElfSymbolTableInfo(pkgfile_path, extra_flags)
-        self.comment_section_info = ElfCommentInfo(pkgfile_path, extra_flags)
+        return [flag] if flag in output else []
+
+    @staticmethod
+    def _run_readelf(paths, extra_flags, headers=True):
+        """
+        Run readelf a single time for section headers, program headers,
+        dynamic section and symbol tables of all paths, and split its output
+        into the regions consumed by the respective Elf*Info classes.
+        Program headers and dynamic section are skipped if headers is False.
+
+        Return a tuple of the failure reason (None on success) and a list
+        with a dict for each path, mapping each Elf*Info class to the list
+        of its lines.
+        """
+        infos = (ElfSectionInfo, ElfProgramHeaderInfo, ElfDynamicSectionInfo, ElfSymbolTableInfo)
+        regions = [{info: [] for info in infos} for _ in paths]
+        options = ['-W', '-S', '-l', '-d', '-Ui', '-s'] if headers else ['-W', '-S', '-Ui', '-s']
+
+        # The output is consumed line by line while readelf runs, so the
+        # whole (possibly multi-MB) output is never held as one string.
+        # stderr goes to a file: a full stderr pipe would block readelf
+        # while we are waiting for stdout.
+        with tempfile.TemporaryFile('w+', encoding='utf8', errors='replace') as stderr, \
+                subprocess.Popen([readelf_path()] + options + paths + extra_flags,
+                                 stdout=subprocess.PIPE, stderr=stderr, encoding='utf8',
+                                 errors='replace', env=ENGLISH_ENVIRONMENT, close_fds=False) as proc:
+            # Headings start at the beginning of a line, region content is
+            # indented (or is a trailer like 'Key to Flags:' that belongs to
+            # the current region). Files (if there are several of them) and
+            # archive members are announced by 'File:', in the order of paths.
+            index = 0
+            file_regions = regions[0]
+            current = None
+            for line in proc.stdout:
+                line = line.rstrip('\n')
+                if line[:1] not in ('', ' '):
+                    if line.startswith('File: '):
+                        name = line[6:]
+                        file_regions = None
+                        for j in range(index, len(paths)):
+                            if name == paths[j] or name.startswith(paths[j] + '('):
+                                index = j
+                                file_regions = regions[j]
+                                break
+                        current = None
+                        continue
+                    if file_regions is not None:
+                        for info in infos:
+                            if line.startswith(info.heading):
+                                current = file_regions[info]
+                                break
+                if current is not None:
+                    current.append(line)
+
+            if proc.wait() != 0:
+                stderr.seek(0)
+                return stderr.read(), [{info: [] for info in infos} for _ in paths]
+
+        return None, regions
 
     def parsing_failed_reason(self):
-        reasons = [self.section_info.parsing_failed_reason,
-                   self.program_header_info.parsing_failed_reason,
-                   self.dynamic_section_info.parsing_failed_reason,
-                   self.symbol_table_info.parsing_failed_reason,
+        reasons = [self.readelf_failed_reason,
                    self.comment_section_info.parsing_failed_reason]
         reasons = [r for r in reasons if r]
         for reason in reasons:
@@ -50,6 +50,39 @@ def test_simple_archive():
     assert elf_file[0].size == 21
     assert readelf.symbol_table_info.functions == {'main'}
     assert len(list(readelf.symbol_table_info.get_functions_for_regex(re.compile('mai.')))) == 1
+    assert list(readelf.symbol_table_info.get_functions_for_regex('^mai.$')) == ['main']
+
+
+def test_parse_cache():
+    readelf = readelfparser('main.a')
+    readelf2 = readelfparser('main.a')
+    assert readelf.section_info is readelf2.section_info
+    assert readelf.symbol_table_info is readelf2.symbol_table_info
+
+
+def test_bulk_parse():
+    paths = [get_full_path(p) for p in ('main.a', 'empty-archive.a', 'libutil-2.29.so', 'rpath-lib.so')]
+    ReadelfParser._parse_elf.cache_clear()
+    ReadelfParser.bulk_parse(paths)
+    assert len(ReadelfParser._prefetched) == 4
+
+    readelf = ReadelfParser(paths[0], 'main.a')
+    assert len(readelf.section_info.elf_files) == 1
+    assert readelf.symbol_table_info.functions == {'main'}
+    readelf = ReadelfParser(paths[1], 'empty-archive.a')
+    assert len(readelf.section_info.elf_files) == 0
+    readelf = ReadelfParser(paths[2], '/lib64/libutil-2.29.so')
+    assert readelf.dynamic_section_info.soname == 'libutil.so.1'
+    assert len(readelf.dynamic_section_info.sections) == 30
+    readelf = ReadelfParser(paths[3], '/lib64/rpath-lib.so')
+    assert '/tmp/termcap.so.4' in readelf.dynamic_section_info.runpaths
+    assert not ReadelfParser._prefetched
+
+
+def test_bulk_parse_failure():
+    paths = [get_full_path(p) for p in ('main.a', 'small_archive.a')]
+    ReadelfParser.bulk_parse(paths)
+    assert not ReadelfParser._prefetched
 
 
 def test_program_header_parsing():
@@ -58,9 +91,11 @@ def test_program_header_parsing():
     h0 = readelf.program_header_info.headers[0]
     assert h0.name == 'PHDR'
     assert h0.flags == 'R'
+    assert not h0.has_exec
     h9 = readelf.program_header_info.headers[9]
     assert h9.name == 'GNU_STACK'
     assert h9.flags == 'RWE'
+    assert h9.has_exec
 
 
 def test_dynamic_section_parsing():